@@ -0,0 +1,29 @@
+import numba
+import numpy as np
+
+from plantseg.dataprocessing.functional.dataprocessing import _minmax
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def norm_invert_mask(x, thr, out, mask, x_min, x_max):
+    """
+    Fused equivalent of: out = 1 - (x - x_min) / (x_max - x_min); mask = out < thr
+    x, out and mask are flat arrays of the same size, out and mask are written in place
+    """
+    scale = 1. / (x_max - x_min + 1e-12)
+    for i in numba.prange(x.shape[0]):
+        value = 1. - (x[i] - x_min) * scale
+        out[i] = value
+        mask[i] = value < thr
+
+
+def normalize_invert_mask(x, thr):
+    """ normalize x to [0, 1] and invert it, returns the inverted image and the mask of values below thr """
+    x = np.ascontiguousarray(x)
+    out = np.empty(x.shape, dtype='float32')
+    mask = np.empty(x.shape, dtype=np.bool_)
+    if x.size > 0:
+        flat_x = x.ravel()
+        x_min, x_max = _minmax(flat_x)
+        norm_invert_mask(flat_x, float(thr), out.ravel(), mask.ravel(), float(x_min), float(x_max))
+    return out, mask
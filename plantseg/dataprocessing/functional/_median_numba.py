@@ -0,0 +1,74 @@
+import numpy as np
+from numba import njit, prange
+
+
+def footprint_offsets(footprint):
+    """ convert a boolean footprint (disk or ball) into an array of offsets relative to its center """
+    center = np.array(footprint.shape) // 2
+    return (np.argwhere(footprint) - center).astype(np.int64)
+
+
+@njit(cache=True)
+def _quickselect(buffer, kth):
+    # in-place nth_element, buffer is partially reordered
+    left, right = 0, buffer.shape[0] - 1
+    while left < right:
+        pivot = buffer[(left + right) // 2]
+        i, j = left, right
+        while i <= j:
+            while buffer[i] < pivot:
+                i += 1
+            while buffer[j] > pivot:
+                j -= 1
+            if i <= j:
+                buffer[i], buffer[j] = buffer[j], buffer[i]
+                i += 1
+                j -= 1
+
+        if kth <= j:
+            right = j
+        elif kth >= i:
+            left = i
+        else:
+            break
+    return buffer[kth]
+
+
+@njit(parallel=True, cache=True)
+def _median2d(image, offsets):
+    shape_y, shape_x = image.shape
+    num_offsets = offsets.shape[0]
+    kth = num_offsets // 2
+    out = np.empty_like(image)
+
+    for y in prange(shape_y):
+        buffer = np.empty(num_offsets, dtype=image.dtype)
+        for x in range(shape_x):
+            for i in range(num_offsets):
+                # boundary voxels are replicated (same as mode='nearest')
+                yy = min(max(y + offsets[i, 0], 0), shape_y - 1)
+                xx = min(max(x + offsets[i, 1], 0), shape_x - 1)
+                buffer[i] = image[yy, xx]
+            out[y, x] = _quickselect(buffer, kth)
+    return out
+
+
+@njit(parallel=True, cache=True)
+def _median3d(image, offsets):
+    shape_z, shape_y, shape_x = image.shape
+    num_offsets = offsets.shape[0]
+    kth = num_offsets // 2
+    out = np.empty_like(image)
+
+    for z in prange(shape_z):
+        buffer = np.empty(num_offsets, dtype=image.dtype)
+        for y in range(shape_y):
+            for x in range(shape_x):
+                for i in range(num_offsets):
+                    # boundary voxels are replicated (same as mode='nearest')
+                    zz = min(max(z + offsets[i, 0], 0), shape_z - 1)
+                    yy = min(max(y + offsets[i, 1], 0), shape_y - 1)
+                    xx = min(max(x + offsets[i, 2], 0), shape_x - 1)
+                    buffer[i] = image[zz, yy, xx]
+                out[z, y, x] = _quickselect(buffer, kth)
+    return out
@@ -1,9 +1,13 @@
+import functools
+
+import numba
 import numpy as np
 from scipy.ndimage import zoom
-from skimage.filters import median
 from skimage.morphology import disk, ball
 from vigra import gaussianSmoothing
 
+from plantseg.dataprocessing.functional._median_numba import footprint_offsets, _median2d, _median3d
+
 
 def compute_scaling_factor(input_voxel_size, output_voxel_size):
     scaling = [i_size / o_size for i_size, o_size in zip(input_voxel_size, output_voxel_size)]
@@ -21,34 +25,62 @@ def scale_image_to_voxelsize(image, input_voxel_size, output_voxel_size, order=0
 
 
 def image_rescale(image, factor, order):
-    if np.array_equal(factor, [1., 1., 1.]):
+    factor = np.asarray(factor, dtype='float64')
+    if np.all(factor == 1.):
         return image
-    else:
+
+    batch_axes = [ax for ax, f in enumerate(factor) if f == 1.]
+    if not batch_axes:
         return zoom(image, zoom=factor, order=order)
 
+    # axes with unit factor are left untouched by the zoom,
+    # iterate over them and zoom the lower dimensional slices instead of the full volume
+    num_batch = len(batch_axes)
+    zoom_factor = factor[factor != 1.]
+    _image = np.moveaxis(image, batch_axes, range(num_batch))
+    batch_shape, slice_shape = _image.shape[:num_batch], _image.shape[num_batch:]
+    _image = _image.reshape((-1,) + slice_shape)
+
+    out_slice_shape = tuple(int(round(s * f)) for s, f in zip(slice_shape, zoom_factor))
+    rescaled = np.empty((_image.shape[0],) + out_slice_shape, dtype=image.dtype)
+    for i, _slice in enumerate(_image):
+        zoom(_slice, zoom=zoom_factor, order=order, output=rescaled[i])
+
+    rescaled = rescaled.reshape(batch_shape + out_slice_shape)
+    return np.ascontiguousarray(np.moveaxis(rescaled, range(num_batch), batch_axes))
+
 
 def image_median(image, radius):
+    image = np.ascontiguousarray(image)
     if image.shape[0] == 1:
         shape = image.shape
-        median_image = median(image[0], disk(radius))
+        median_image = _median2d(image[0], footprint_offsets(disk(radius)))
         return median_image.reshape(shape)
     else:
-        return median(image, ball(radius))
+        return _median3d(image, footprint_offsets(ball(radius)))
 
 
 def image_gaussian_smoothing(image, sigma):
-    image = image.astype('float32')
+    image = np.ascontiguousarray(image, dtype=np.float32)
     max_sigma = (np.array(image.shape) - 1) / 3
     sigma = np.minimum(max_sigma, np.ones(max_sigma.ndim) * sigma)
     return gaussianSmoothing(image, sigma)
 
 
-def image_crop(image, crop_str):
-    crop_str = crop_str.replace('[', '').replace(']', '')
+_CROP_STRIP_TABLE = str.maketrans('', '', '[]')
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_crop(crop_str):
+    crop_str = crop_str.translate(_CROP_STRIP_TABLE)
     slices = tuple((slice(*(int(i)
                             if i else None for i in part.strip().split(':')))
                     if ':' in part else int(part.strip())) for part in crop_str.split(','))
-    return image[slices]
+    return slices
+
+
+def image_crop(image, crop_str):
+    return image[_parse_crop(crop_str)]
 
 
 def fix_input_shape(data):
@@ -65,5 +97,29 @@ def fix_input_shape(data):
         raise RuntimeError(f"Expected input data to be 2d, 3d or 4d, but got {data.ndim}d input")
 
 
+@numba.njit(parallel=True, cache=True)
+def _minmax(data):
+    data_min, data_max = data[0], data[0]
+    for i in numba.prange(data.shape[0]):
+        data_min = min(data_min, data[i])
+        data_max = max(data_max, data[i])
+    return data_min, data_max
+
+
+@numba.njit(parallel=True, cache=True)
+def _normalize_01(data, out, data_min, data_max):
+    scale = 1. / (data_max - data_min + 1e-12)
+    for i in numba.prange(data.shape[0]):
+        out[i] = (data[i] - data_min) * scale
+
+
 def normalize_01(data):
-    return (data - np.min(data)) / (np.max(data) - np.min(data) + 1e-12).astype('float32')
+    flat_data = np.ascontiguousarray(data).ravel()
+    out = np.empty(flat_data.shape, dtype='float32')
+    if flat_data.size == 0:
+        return out.reshape(data.shape)
+
+    # single pass min/max reduction followed by a single fused rescaling pass
+    data_min, data_max = _minmax(flat_data)
+    _normalize_01(flat_data, out, float(data_min), float(data_max))
+    return out.reshape(data.shape)
@@ -11,8 +11,20 @@ def relabel_segmentation(segmentation_image):
 
 
 def set_background_to_value(segmentation_image, value: int = 0):
-    segmentation_image += 1
-    idx, counts = np.unique(segmentation_image, return_counts=True)
-    bg_idx = idx[np.argmax(counts)]
-    return np.where(segmentation_image == bg_idx, value, segmentation_image)
+    """
+    Set the most frequent label (background) to value, all other labels are shifted by one to avoid clashes.
+    """
+    flat_segmentation = segmentation_image.ravel()
+    if not np.issubdtype(segmentation_image.dtype, np.integer) \
+            or int(flat_segmentation.max()) > 2 * flat_segmentation.size or int(flat_segmentation.min()) < 0:
+        # non integer, sparse (e.g. hashed) or negative ids, a dense lookup table would not fit
+        idx, counts = np.unique(flat_segmentation, return_counts=True)
+        bg_idx = idx[np.argmax(counts)]
+        return np.where(segmentation_image == bg_idx, value, segmentation_image + 1)
 
+    # bincount does not accept uint64 inputs
+    counts = np.bincount(flat_segmentation.astype(np.int64, copy=False))
+    bg_idx = np.argmax(counts)
+    lut = np.arange(1, counts.size + 1, dtype=segmentation_image.dtype)
+    lut[bg_idx] = value
+    return lut[segmentation_image]
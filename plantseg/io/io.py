@@ -1,3 +1,4 @@
+import functools
 import os
 import warnings
 
@@ -7,6 +8,13 @@ import tifffile
 import warnings
 from xml.etree import cElementTree as ElementTree
 
+try:
+    import hdf5plugin
+
+    hdf5plugin_installed = True
+except ImportError:
+    hdf5plugin_installed = False
+
 TIFF_EXTENSIONS = [".tiff", ".tif"]
 H5_EXTENSIONS = [".hdf", ".h5", ".hd5", "hdf5"]
 
@@ -43,41 +51,28 @@ def _read_ome_meta(tiff):
     xml_om = tiff.ome_metadata
     tree = ElementTree.fromstring(xml_om)
 
-    image_element = [image for image in tree if image.tag.find('Image') != -1]
-    if image_element:
-        image_element = image_element[0]
-    else:
+    image_element = tree.find('{*}Image')
+    if image_element is None:
         warnings.warn(f'Error parsing omero tiff meta Image. '
                       f'Reverting to default voxel size (1., 1., 1.) um')
         return [1., 1., 1.], 'um'
 
-    pixels_element = [pixels for pixels in image_element if pixels.tag.find('Pixels') != -1]
-    if pixels_element:
-        pixels_element = pixels_element[0]
-    else:
+    pixels_element = image_element.find('{*}Pixels')
+    if pixels_element is None:
         warnings.warn(f'Error parsing omero tiff meta Pixels. '
                       f'Reverting to default voxel size (1., 1., 1.) um')
         return [1., 1., 1.], 'um'
 
-    units = []
-    x, y, z, voxel_size_unit = None, None, None, 'um'
-
-    for key, value in pixels_element.items():
-        if key == 'PhysicalSizeX':
-            x = float(value)
-
-        elif key == 'PhysicalSizeY':
-            y = float(value)
-
-        elif key == 'PhysicalSizeZ':
-            z = float(value)
-
-        if key in ['PhysicalSizeXUnit', 'PhysicalSizeYUnit', 'PhysicalSizeZUnit']:
-            units.append(value)
+    # direct attribute lookups instead of iterating over all the Pixels attributes
+    x, y, z = [pixels_element.get(key) for key in ['PhysicalSizeX', 'PhysicalSizeY', 'PhysicalSizeZ']]
+    x, y, z = [float(value) if value is not None else None for value in (x, y, z)]
+    units = [pixels_element.get(key) for key in ['PhysicalSizeXUnit', 'PhysicalSizeYUnit', 'PhysicalSizeZUnit']
+             if key in pixels_element.attrib]
 
+    voxel_size_unit = 'um'
     if units:
         voxel_size_unit = units[0]
-        if not np.alltrue([_value == units[0] for _value in units]):
+        if not all(_value == units[0] for _value in units):
             warnings.warn(f'Units are not homogeneous: {units}')
 
     if x is None:
@@ -130,6 +125,11 @@ def read_h5_voxel_size(f, h5key):
 
 
 def _find_input_key(h5_file):
+    # probe the expected keys first to avoid walking the whole file tree in the common case
+    for h5_key in H5_KEYS:
+        if isinstance(h5_file.get(h5_key), h5py.Dataset):
+            return h5_key
+
     found_datasets = []
 
     def visitor_func(name, node):
@@ -144,15 +144,34 @@ def _find_input_key(h5_file):
     if len(found_datasets) == 1:
         return found_datasets[0]
     else:
-        print(found_datasets)
-        for h5_key in H5_KEYS:
-            if h5_key in found_datasets:
-                return h5_key
-
         raise RuntimeError(f"Ambiguous datasets '{found_datasets}' in {h5_file.filename}. "
                            f"plantseg expects only one dataset to be present in input H5.")
 
 
+def _sliced_shape(shape, slices):
+    """ compute the shape of a dataset after slicing with a tuple of slices and integers """
+    slices = slices if isinstance(slices, tuple) else (slices,)
+    sliced_shape = []
+    for dim, _slice in zip(shape, slices):
+        if isinstance(_slice, slice):
+            sliced_shape.append(len(range(*_slice.indices(dim))))
+
+    sliced_shape += shape[len(slices):]
+    return tuple(sliced_shape)
+
+
+def _is_basic_selection(slices):
+    """ True if slices is a slice, an int or a tuple of slices and ints (no ellipsis, lists or arrays) """
+    slices = slices if isinstance(slices, tuple) else (slices,)
+    return all(isinstance(_slice, (slice, int, np.integer)) for _slice in slices)
+
+
+def _check_chunks(ds, min_chunk_bytes=4096):
+    if ds.chunks is not None and np.prod(ds.chunks) * ds.dtype.itemsize < min_chunk_bytes:
+        warnings.warn(f'Dataset {ds.name} has a very small chunk shape {ds.chunks}, '
+                      f'reading it might be extremely slow.', RuntimeWarning)
+
+
 def load_h5(path, key, slices=None, info_only=False):
     with h5py.File(path, 'r') as f:
         if key is None:
@@ -165,7 +184,19 @@ def load_h5(path, key, slices=None, info_only=False):
         if info_only:
             return infos
 
-        file = f[key][...] if slices is None else f[key][slices]
+        # read directly into a preallocated buffer to bypass the h5py high level indexing
+        ds = f[key]
+        _check_chunks(ds)
+        if slices is not None and not _is_basic_selection(slices):
+            # ellipsis and fancy selections are left to h5py
+            return ds[slices], infos
+
+        slices = np.s_[:] if slices is None else slices
+        file = np.empty(_sliced_shape(ds.shape, slices), dtype=ds.dtype)
+        if file.size == 0:
+            return file, infos
+
+        ds.read_direct(file, source_sel=slices)
 
     return file, infos
 
@@ -200,14 +231,87 @@ def smart_load(path, key=None, info_only=False, default=load_tiff):
         return default(path)
 
 
+@functools.lru_cache(maxsize=128)
+def _cached_h5_infos(path, key, mtime):
+    # mtime is part of the cache key, so that modified files are parsed again
+    return load_h5(path, key, info_only=True)
+
+
 def load_shape(path, key=None):
-    _, data_shape, _, _ = smart_load(path, key=key, info_only=True)
+    _, ext = os.path.splitext(path)
+    if ext in H5_EXTENSIONS:
+        _, data_shape, _, _ = _cached_h5_infos(path, key, os.path.getmtime(path))
+    else:
+        _, data_shape, _, _ = smart_load(path, key=key, info_only=True)
     return data_shape
 
 
-def create_h5(path, stack, key, voxel_size=(1.0, 1.0, 1.0), mode='a'):
+def _compression_kwargs(compression):
+    if compression in ['blosc', 'bitshuffle']:
+        if not hdf5plugin_installed:
+            raise ValueError(f'please install hdf5plugin before using {compression} compression')
+
+        if compression == 'blosc':
+            return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+        return dict(hdf5plugin.Bitshuffle())
+
+    return {'compression': compression}
+
+
+def _largest_divisor(dim, max_size):
+    """ largest divisor of dim not larger than max_size, fall back to max_size if none is reasonably close """
+    for size in range(max_size, max_size // 2, -1):
+        if dim % size == 0:
+            return size
+    return max_size
+
+
+def _suggest_chunks(shape, dtype, target_bytes=1 << 20, axis_priority=None):
+    """
+    Suggest a chunk shape of at most target_bytes (when possible). Axes are shrunk in axis_priority order,
+    by default the leading axes are shrunk first in order to keep full XY tiles for volumetric reads.
+    """
+    if len(shape) == 0 or 0 in shape:
+        return None
+
+    itemsize = np.dtype(dtype).itemsize
+    axis_priority = range(len(shape)) if axis_priority is None else axis_priority
+    chunks = list(shape)
+    for ax in axis_priority:
+        other_bytes = int(np.prod(chunks)) // chunks[ax] * itemsize
+        max_size = max(target_bytes // other_bytes, 1)
+        if chunks[ax] <= max_size:
+            break
+
+        chunks[ax] = _largest_divisor(chunks[ax], max_size)
+    return tuple(chunks)
+
+
+def _iter_chunk_slabs(shape, chunks):
+    """ iterate over slabs of full chunks along the first axis """
+    for start in range(0, shape[0], chunks[0]):
+        yield np.s_[start:min(start + chunks[0], shape[0])]
+
+
+def create_h5(path, stack, key, voxel_size=(1.0, 1.0, 1.0), mode='a', compression='gzip', chunks=True):
+    """
+    compression can be any h5py compression filter ('gzip', 'lzf', None)
+    or 'blosc' / 'bitshuffle' (lz4 based, both require hdf5plugin).
+    gzip is the only one readable by every libhdf5 based reader (Fiji, MATLAB, ...), the others are opt-in.
+    """
+    stack = np.ascontiguousarray(stack)
+    if chunks is True:
+        chunks = _suggest_chunks(stack.shape, stack.dtype)
+
     with h5py.File(path, mode) as f:
-        f.create_dataset(key, data=stack, compression='gzip')
+        if not chunks or stack.size == 0:
+            f.create_dataset(key, data=stack, chunks=chunks, **_compression_kwargs(compression))
+        else:
+            # write slab by slab to avoid compressing the whole stack in one shot
+            ds = f.create_dataset(key, shape=stack.shape, dtype=stack.dtype, chunks=chunks,
+                                  **_compression_kwargs(compression))
+            for slab in _iter_chunk_slabs(stack.shape, chunks):
+                ds.write_direct(stack, source_sel=slab, dest_sel=slab)
         # save voxel_size
         f[key].attrs['element_size_um'] = voxel_size
 
@@ -236,13 +340,16 @@ def rename_h5_key(path, old_key, new_key, mode='r+'):
 def create_tiff(path, stack, voxel_size, voxel_size_unit='um'):
     # taken from: https://pypi.org/project/tifffile docs
     z, y, x = stack.shape
-    stack.shape = 1, z, 1, y, x, 1  # dimensions in TZCYXS order
+    # reshape returns a view, the input stack shape is not modified
+    stack = stack.reshape(1, z, 1, y, x, 1)  # dimensions in TZCYXS order
     spacing, y, x = voxel_size
     resolution = (1. / x, 1. / y)
+    # classic (ImageJ) tiff is limited to 4GB, larger stacks are saved as BigTIFF
+    bigtiff = stack.nbytes >= 4 * 1024 ** 3
     # Save output results as tiff
     tifffile.imwrite(path,
                      data=stack,
-                     dtype=stack.dtype,
-                     imagej=True,
+                     imagej=not bigtiff,
+                     bigtiff=bigtiff,
                      resolution=resolution,
                      metadata={'axes': 'TZCYXS', 'spacing': spacing, 'unit': voxel_size_unit})
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 import pytorch3dunet.augment.transforms as transforms
 from pytorch3dunet.datasets.utils import get_slice_builder, calculate_stats, default_prediction_collate
 from pytorch3dunet.unet3d.utils import get_logger
@@ -7,6 +8,97 @@ from torch.utils.data import Dataset
 logger = get_logger('ArrayDataset')
 
 
+class ReflectPadView:
+    """
+    Lazy equivalent of np.pad(array, pad_width, mode='reflect') over the last len(pad_width) axes,
+    leading (channel) axes are not padded. Only the patches requested via __getitem__ are materialized.
+    """
+
+    def __init__(self, array, pad_width):
+        self.array = array
+        self.pad_width = tuple(pad_width)
+        self.num_channel_axes = array.ndim - len(self.pad_width)
+
+        spatial_shape = array.shape[self.num_channel_axes:]
+        self.shape = array.shape[:self.num_channel_axes] + tuple(s + 2 * p for s, p in zip(spatial_shape,
+                                                                                            self.pad_width))
+        self.ndim = array.ndim
+        self.dtype = array.dtype
+
+    @staticmethod
+    def _reflect_indices(start, stop, pad, size):
+        indices = np.arange(start - pad, stop - pad)
+        if size == 1:
+            return np.zeros_like(indices)
+
+        period = 2 * (size - 1)
+        indices = np.abs(indices) % period
+        return np.where(indices >= size, period - indices, indices)
+
+    def __getitem__(self, idx):
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        idx = idx + (slice(None),) * (self.ndim - len(idx))
+        channel_idx, spatial_idx = idx[:self.num_channel_axes], idx[self.num_channel_axes:]
+
+        inner_idx, spatial_indices, is_inner = [], [], True
+        for _slice, pad, size, padded_size in zip(spatial_idx,
+                                                  self.pad_width,
+                                                  self.array.shape[self.num_channel_axes:],
+                                                  self.shape[self.num_channel_axes:]):
+            start, stop, step = _slice.indices(padded_size)
+            assert step == 1, 'ReflectPadView supports only contiguous slices'
+            inner_idx.append(slice(start - pad, stop - pad))
+            spatial_indices.append(self._reflect_indices(start, stop, pad, size))
+            is_inner = is_inner and start >= pad and stop <= pad + size
+
+        if is_inner:
+            # patch fully inside the original array, no reflection needed
+            return self.array[channel_idx + tuple(inner_idx)]
+
+        return self.array[channel_idx + np.ix_(*spatial_indices)]
+
+
+class FusedRawTransform:
+    """
+    Standardize a patch with precomputed stats and convert it to a float32 tensor, module level so it can be pickled
+    """
+
+    def __init__(self, mean, inv_std, expand_dims):
+        self.mean = mean
+        self.inv_std = inv_std
+        self.expand_dims = expand_dims
+
+    def __call__(self, patch):
+        patch = ((patch - self.mean) * self.inv_std).astype(np.float32, copy=False)
+        if self.expand_dims and patch.ndim == 3:
+            patch = patch[None]
+        return torch.from_numpy(patch)
+
+
+def fuse_raw_transform(raw_transform):
+    """
+    Fuse the standard inference pipeline [Standardize(mean, std), ToTensor()] with precomputed (global) stats into a
+    single numpy expression. Returns None if the raw_transform is any other pipeline.
+    """
+    pipeline = getattr(raw_transform, 'transforms', None)
+    if pipeline is None or len(pipeline) != 2:
+        return None
+
+    standardize, to_tensor = pipeline
+    if not (isinstance(standardize, transforms.Standardize) and isinstance(to_tensor, transforms.ToTensor)):
+        return None
+
+    if standardize.mean is None or standardize.std is None or getattr(standardize, 'channelwise', False):
+        return None
+
+    if getattr(to_tensor, 'dtype', np.float32) != np.float32:
+        return None
+
+    mean = np.float32(standardize.mean)
+    inv_std = np.float32(1. / max(standardize.std, standardize.eps))
+    return FusedRawTransform(mean, inv_std, to_tensor.expand_dims)
+
+
 class ArrayDataset(Dataset):
     """
     Based on pytorch-3dunet  AbstractHDF5Dataset
@@ -21,12 +113,14 @@ class ArrayDataset(Dataset):
                  mirror_padding=(16, 32, 32),
                  global_normalization=True,
                  verbose_logging=True,
+                 precast=True,
                  **kwargs):
         """
         :param raw: numpy array containing the raw image
         :para'/home/adrian/workspace/ilastik-datasets/VolkerDeconv/train'm slice_builder_config: configuration of the SliceBuilder
         :param transformer_config: data augmentation configuration
         :param mirror_padding (int or tuple): number of voxels padded to each axis
+        :param precast (bool): cast raw to a contiguous float32 array once, instead of casting every patch
         """
         self.slice_builder_config = slice_builder_config
 
@@ -39,6 +133,9 @@ class ArrayDataset(Dataset):
         self.mirror_padding = mirror_padding
 
         self.raw = raw
+        if precast:
+            # no copy if raw is already a contiguous float32 array
+            self.raw = np.ascontiguousarray(self.raw, dtype=np.float32)
 
         if global_normalization:
             stats = calculate_stats(self.raw)
@@ -47,20 +144,18 @@ class ArrayDataset(Dataset):
 
         self.transformer = transforms.Transformer(transformer_config, stats)
         self.raw_transform = self.transformer.raw_transform()
+        # avoid the per patch python transforms dispatch for the standard inference pipeline
+        fused_raw_transform = fuse_raw_transform(self.raw_transform)
+        if fused_raw_transform is not None:
+            self.raw_transform = fused_raw_transform
 
         # 'test' phase used only for predictions so ignore the label dataset
         self.label = None
         self.weight_map = None
 
-        # add mirror padding if needed
+        # add mirror padding if needed, padding is lazy and applied only to the requested patches
         if self.mirror_padding is not None:
-            z, y, x = self.mirror_padding
-            pad_width = ((z, z), (y, y), (x, x))
-            if self.raw.ndim == 4:
-                channels = [np.pad(r, pad_width=pad_width, mode='reflect') for r in self.raw]
-                self.raw = np.stack(channels)
-            else:
-                self.raw = np.pad(self.raw, pad_width=pad_width, mode='reflect')
+            self.raw = ReflectPadView(self.raw, pad_width=self.mirror_padding)
 
         # build slice indices for raw and label data sets
         slice_builder = get_slice_builder(self.raw, self.label, self.weight_map, slice_builder_config)
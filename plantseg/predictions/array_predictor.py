@@ -32,7 +32,12 @@ class ArrayPredictor:
     def __call__(self, test_dataset):
         assert isinstance(test_dataset, ArrayDataset)
 
-        test_loader = DataLoader(test_dataset, batch_size=1, collate_fn=test_dataset.prediction_collate)
+        # pinned batches allow asynchronous host to device copies
+        pin_memory = torch.device(self.device).type == 'cuda'
+        test_loader = DataLoader(test_dataset,
+                                 batch_size=1,
+                                 pin_memory=pin_memory,
+                                 collate_fn=test_dataset.prediction_collate)
 
         if self.mute_logging:
             logger.info(f"Processing...")
@@ -79,7 +84,7 @@ class ArrayPredictor:
         with torch.no_grad():
             for batch, indices in test_loader:
                 # send batch to device
-                batch = batch.to(self.device)
+                batch = batch.to(self.device, non_blocking=True)
 
                 # forward pass
                 predictions = self.model(batch)
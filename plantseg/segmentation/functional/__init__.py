@@ -1,6 +1,10 @@
 from plantseg.segmentation.functional.segmentation import dt_watershed
+from plantseg.segmentation.functional.segmentation import dt_watershed_gpu
 from plantseg.segmentation.functional.segmentation import gasp
 from plantseg.segmentation.functional.segmentation import lifted_multicut_from_nuclei_pmaps
 from plantseg.segmentation.functional.segmentation import lifted_multicut_from_nuclei_segmentation
 from plantseg.segmentation.functional.segmentation import multicut
 from plantseg.segmentation.functional.segmentation import mutex_ws
+from plantseg.segmentation.functional.segmentation import compute_dt_seeds
+from plantseg.segmentation.functional.segmentation import finalize_dt_watershed
+from plantseg.segmentation.functional.segmentation import tiled_dt_watershed
@@ -0,0 +1,75 @@
+import numpy as np
+from numba import njit
+
+
+@njit(inline='always')
+def _find(parent, x):
+    root = x
+    while parent[root] != root:
+        root = parent[root]
+
+    # second pass, path compression
+    while parent[x] != root:
+        next_x = parent[x]
+        parent[x] = root
+        x = next_x
+    return root
+
+
+@njit(inline='always')
+def _union(parent, rank, a, b):
+    if rank[a] < rank[b]:
+        a, b = b, a
+
+    parent[b] = a
+    if rank[a] == rank[b]:
+        rank[a] += 1
+    return a
+
+
+@njit(cache=True)
+def _merge_small_nodes(edges_u, edges_v, order, sizes, min_size):
+    num_nodes = sizes.shape[0]
+    parent = np.arange(num_nodes)
+    rank = np.zeros(num_nodes, dtype=np.int64)
+    component_sizes = sizes.astype(np.int64)
+
+    for e in order:
+        root_u, root_v = _find(parent, edges_u[e]), _find(parent, edges_v[e])
+        if root_u == root_v:
+            continue
+
+        if component_sizes[root_u] < min_size or component_sizes[root_v] < min_size:
+            new_size = component_sizes[root_u] + component_sizes[root_v]
+            root = _union(parent, rank, root_u, root_v)
+            component_sizes[root] = new_size
+
+    roots = np.empty(num_nodes, dtype=np.int64)
+    for node in range(num_nodes):
+        roots[node] = _find(parent, node)
+    return roots
+
+
+def merge_small(labels_flat, edges_u, edges_v, edge_weights, sizes, min_size):
+    """
+    Merge components smaller than min_size with their neighbours (union-find), edges with lower weight are merged first.
+
+    Args:
+        labels_flat (np.ndarray): flat label image, labels are node ids of the graph.
+        edges_u, edges_v (np.ndarray): edges endpoints.
+        edge_weights (np.ndarray): edges weights (e.g. mean boundary probability).
+        sizes (np.ndarray): size of each node.
+        min_size (int): minimum component size.
+
+    Returns:
+        np.ndarray: flat label image, labels are consecutive and start from 1.
+    """
+    order = np.argsort(edge_weights, kind='stable')
+    roots = _merge_small_nodes(edges_u.astype(np.int64), edges_v.astype(np.int64), order, sizes, min_size)
+
+    # consecutive relabeling of the nodes present in the label image
+    present = sizes > 0
+    _, new_ids = np.unique(roots[present], return_inverse=True)
+    lut = np.zeros(sizes.shape[0], dtype=labels_flat.dtype)
+    lut[present] = new_ids + 1
+    return lut[labels_flat]
@@ -1,3 +1,6 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from functools import partial
 import nifty
@@ -8,11 +11,16 @@ from elf.segmentation import stacked_watershed, lifted_multicut as lmc, \
     project_node_labels_to_pixels
 from elf.segmentation.features import compute_rag, lifted_problem_from_probabilities, lifted_problem_from_segmentation
 from elf.segmentation.multicut import multicut_kernighan_lin
-from elf.segmentation.watershed import distance_transform_watershed, apply_size_filter
+from elf.segmentation.watershed import distance_transform_watershed
+from elf.segmentation.watershed import watershed as seeded_watershed, non_maximum_suppression
 from numpy.typing import ArrayLike
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+import vigra
 from vigra.filters import gaussianSmoothing
 
-from plantseg.segmentation.functional.utils import shift_affinities, compute_mc_costs
+from plantseg.segmentation.functional.utils import build_inverted_affinities, compute_mc_costs, parallel_take, \
+    merge_small_segments, offset_stacked_labels
 
 try:
     import SimpleITK as sitk
@@ -21,6 +29,20 @@ try:
 except ImportError:
     sitk_installed = False
 
+try:
+    import cupy as cp
+    from cupyx.scipy import ndimage as cu_ndimage
+    from cucim.core.operations.morphology import distance_transform_edt as cu_distance_transform_edt
+
+    cucim_installed = True
+except ImportError:
+    cucim_installed = False
+
+
+def _as_f32(array: ArrayLike) -> ArrayLike:
+    """ cast to a contiguous float32 array, no copy is made if the input already is one """
+    return np.ascontiguousarray(array, dtype=np.float32)
+
 
 def dt_watershed(boundary_pmaps: ArrayLike,
                  threshold: float = 0.5,
@@ -47,14 +69,15 @@ def dt_watershed(boundary_pmaps: ArrayLike,
         pixel_pitch (list-like[int]): anisotropy factor used to compute the distance transform (default: None)
         apply_nonmax_suppression (bool): whether to apply non-maximum suppression to filter out seeds.
             Needs nifty. (default: False)
-        n_threads (int): if not None, parallelize the 2D stacked ws. (default: None)
+        n_threads (int): number of threads used to parallelize the 2D stacked ws over slices,
+            if None all available cores are used. (default: None)
         mask (np.ndarray)
 
     Returns:
         np.ndarray: watershed segmentation
     """
 
-    boundary_pmaps = boundary_pmaps.astype('float32')
+    boundary_pmaps = _as_f32(boundary_pmaps)
     ws_kwargs = dict(threshold=threshold, sigma_seeds=sigma_seeds,
                      sigma_weights=sigma_weights,
                      min_size=min_size, alpha=alpha,
@@ -62,7 +85,8 @@ def dt_watershed(boundary_pmaps: ArrayLike,
                      apply_nonmax_suppression=apply_nonmax_suppression,
                      mask=mask)
     if stacked:
-        # WS in 2D
+        # WS in 2D, slices are independent and processed in parallel (labels are offset across slices)
+        n_threads = os.cpu_count() if n_threads is None else n_threads
         ws, _ = stacked_watershed(boundary_pmaps,
                                   ws_function=distance_transform_watershed,
                                   n_threads=n_threads,
@@ -74,6 +98,284 @@ def dt_watershed(boundary_pmaps: ArrayLike,
     return ws
 
 
+def _local_maxima(dt):
+    compute_maxima = vigra.analysis.localMaxima if dt.ndim == 2 else vigra.analysis.localMaxima3D
+    return np.isnan(compute_maxima(dt, marker=np.nan, allowAtBorder=True, allowPlateaus=True))
+
+
+def _dt_seeds(boundary_pmaps, threshold, sigma_seeds, sigma_weights, alpha, pixel_pitch, mask):
+    # same steps as elf.distance_transform_watershed, up to the seeded watershed
+    thresholded = (boundary_pmaps > threshold).astype('uint32')
+    dt = vigra.filters.distanceTransform(thresholded, pixel_pitch=pixel_pitch)
+    if mask is not None:
+        dt[np.logical_not(mask)] = 0.
+
+    if sigma_seeds:
+        dt = gaussianSmoothing(dt, sigma_seeds)
+
+    seeds = _local_maxima(dt)
+
+    # normalize and invert distance transform and blend it with the input
+    inv_dt = 1. - (dt - dt.min()) / dt.max()
+    if sigma_weights:
+        hmap = alpha * gaussianSmoothing(boundary_pmaps, sigma_weights) + (1. - alpha) * inv_dt
+    else:
+        hmap = alpha * boundary_pmaps + (1. - alpha) * inv_dt
+    return dt, seeds, hmap
+
+
+def _dt_seeds_2d(slice_args, **kwargs):
+    boundary_pmaps, mask = slice_args
+    return _dt_seeds(boundary_pmaps, mask=mask, **kwargs)
+
+
+def _finalize_dt_watershed_2d(slice_args, **kwargs):
+    dt, seeds, hmap, mask = slice_args
+    return _finalize_dt_watershed(dt, seeds, hmap, mask=mask, **kwargs)
+
+
+def _map_slices(func, slices_args, num_slices, **kwargs):
+    # 2D slices are independent and vigra releases the GIL, threads share the slices without copies
+    max_workers = max(min(num_slices, os.cpu_count()), 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(partial(func, **kwargs), slices_args))
+
+
+def compute_dt_seeds(boundary_pmaps: ArrayLike,
+                     threshold: float = 0.5,
+                     sigma_seeds: float = 1.,
+                     stacked: bool = False,
+                     sigma_weights: float = 2.,
+                     alpha: float = 1.0,
+                     pixel_pitch: List[int] = None,
+                     mask: ArrayLike = None):
+    """ First (expensive) stage of dt_watershed: distance transform, seeds candidates and height map
+
+    Args:
+        see dt_watershed
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): smoothed distance transform, boolean seeds and watershed height map
+    """
+    boundary_pmaps = _as_f32(boundary_pmaps)
+    ws_kwargs = dict(threshold=threshold, sigma_seeds=sigma_seeds, sigma_weights=sigma_weights, alpha=alpha)
+    if not stacked:
+        return _dt_seeds(boundary_pmaps, pixel_pitch=pixel_pitch, mask=mask, **ws_kwargs)
+
+    pixel_pitch = pixel_pitch[1:] if pixel_pitch is not None else None
+    num_slices = boundary_pmaps.shape[0]
+    slices_args = [(boundary_pmaps[z], mask[z] if mask is not None else None) for z in range(num_slices)]
+    results = _map_slices(_dt_seeds_2d, slices_args, num_slices, pixel_pitch=pixel_pitch, **ws_kwargs)
+    dt, seeds, hmap = (np.stack(result) for result in zip(*results))
+    return dt, seeds, hmap
+
+
+def _finalize_dt_watershed(dt, seeds, hmap, min_size, apply_nonmax_suppression, mask):
+    if mask is not None and not mask.any():
+        return np.zeros(mask.shape, dtype='uint64')
+
+    if apply_nonmax_suppression:
+        seeds = non_maximum_suppression(dt, seeds)
+    seeds = vigra.analysis.labelMultiArrayWithBackground(seeds.view('uint8'))
+
+    ws, _ = seeded_watershed(hmap, seeds, size_filter=min_size)
+    if mask is not None:
+        ws[np.logical_not(mask)] = 0
+    return ws
+
+
+def finalize_dt_watershed(dt: ArrayLike,
+                          seeds: ArrayLike,
+                          hmap: ArrayLike,
+                          stacked: bool = False,
+                          min_size: int = 100,
+                          apply_nonmax_suppression: bool = False,
+                          mask: ArrayLike = None) -> ArrayLike:
+    """ Second (cheap) stage of dt_watershed: seeds labeling, seeded watershed and size filtering
+
+    Args:
+        dt, seeds, hmap (np.ndarray): outputs of compute_dt_seeds
+        see dt_watershed for the other arguments
+
+    Returns:
+        np.ndarray: watershed segmentation
+    """
+    ws_kwargs = dict(min_size=min_size, apply_nonmax_suppression=apply_nonmax_suppression)
+    if not stacked:
+        return _finalize_dt_watershed(dt, seeds, hmap, mask=mask, **ws_kwargs)
+
+    num_slices = dt.shape[0]
+    slices_args = [(dt[z], seeds[z], hmap[z], mask[z] if mask is not None else None) for z in range(num_slices)]
+    slices_ws = _map_slices(_finalize_dt_watershed_2d, slices_args, num_slices, **ws_kwargs)
+
+    ws = np.stack(slices_ws).astype('uint64')
+    offset_stacked_labels(ws)
+    return ws
+
+
+def _match_blocks(seg_a_plane, seg_b_plane):
+    """
+    Match the labels of two blocks on a plane they share, each label of b is matched to the label of a
+    it overlaps most with, if the overlap covers at least half of it. Returns the (b, a) pairs as a 2 x N array
+    """
+    foreground = (seg_a_plane != 0) & (seg_b_plane != 0)
+    pairs, counts = np.unique(np.stack([seg_b_plane[foreground], seg_a_plane[foreground]]),
+                              axis=1, return_counts=True)
+    if pairs.shape[1] == 0:
+        return pairs
+
+    # keep the largest overlap for each label of b
+    order = np.lexsort((counts, pairs[0]))
+    pairs, counts = pairs[:, order], counts[order]
+    is_best = np.append(pairs[0, 1:] != pairs[0, :-1], True)
+    pairs, counts = pairs[:, is_best], counts[is_best]
+
+    b_ids, b_areas = np.unique(seg_b_plane[seg_b_plane != 0], return_counts=True)
+    areas = b_areas[np.searchsorted(b_ids, pairs[0])]
+    return pairs[:, 2 * counts >= areas]
+
+
+def tiled_dt_watershed(boundary_pmaps: ArrayLike,
+                       z_block: int = 64,
+                       halo: int = None,
+                       sigma_weights: float = 2.,
+                       mask: ArrayLike = None,
+                       **ws_kwargs) -> ArrayLike:
+    """ 3D dt_watershed in z-blocks with a halo, blocks are processed in parallel and their labels are stitched
+    by matching the overlapping labels on the first plane of each block
+
+    Args:
+        boundary_pmaps (np.ndarray): input height map.
+        z_block (int): number of z-slices of each block (default: 64)
+        halo (int): number of z-slices added on both sides of each block,
+            if None it is derived from sigma_weights. (default: None)
+        sigma_weights (float): smoothing factor for the watershed weight map (default: 2).
+        mask (np.ndarray)
+        see dt_watershed for the other arguments
+
+    Returns:
+        np.ndarray: watershed segmentation
+    """
+    halo = int(math.ceil(3 * sigma_weights)) + 1 if halo is None else max(halo, 1)
+    shape_z = boundary_pmaps.shape[0]
+    starts = list(range(0, shape_z, z_block))
+
+    def _run_block(z0):
+        z_start, z_stop = max(0, z0 - halo), min(shape_z, z0 + z_block + halo)
+        _mask = mask[z_start:z_stop] if mask is not None else None
+        ws = dt_watershed(boundary_pmaps[z_start:z_stop], stacked=False, sigma_weights=sigma_weights,
+                          mask=_mask, **ws_kwargs)
+        return z_start, ws
+
+    with ThreadPoolExecutor(max_workers=min(len(starts), os.cpu_count())) as executor:
+        blocks = list(executor.map(_run_block, starts))
+
+    segmentation = np.zeros(boundary_pmaps.shape, dtype='uint64')
+    merge_pairs, offset, previous_block = [], 0, None
+    for z0, (z_start, ws) in zip(starts, blocks):
+        # each block is offset as a whole
+        ws = ws.astype('uint64')
+        next_offset = offset_stacked_labels(ws[None], offset)
+        z_stop = min(z0 + z_block, shape_z)
+        segmentation[z0:z_stop] = ws[z0 - z_start:z_stop - z_start]
+
+        if previous_block is not None:
+            # the first interior plane of this block lies in the halo of the previous one
+            previous_start, previous_ws = previous_block
+            merge_pairs.append(_match_blocks(previous_ws[z0 - previous_start], ws[z0 - z_start]))
+
+        offset = next_offset
+        previous_block = z_start, ws
+
+    # stitch the matched labels, background stays 0
+    pairs = np.concatenate(merge_pairs, axis=1) if merge_pairs else np.zeros((2, 0), dtype='uint64')
+    num_nodes = offset + 1
+    graph = csr_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(num_nodes, num_nodes))
+    _, components = connected_components(graph, directed=False)
+    lut = components.astype('uint64') + 1
+    lut[0] = 0
+    return lut[segmentation]
+
+
+def _dt_watershed_gpu(boundary_pmaps: ArrayLike,
+                      threshold: float,
+                      sigma_seeds: float,
+                      sigma_weights: float,
+                      min_size: int,
+                      alpha: float,
+                      pixel_pitch: List[int],
+                      apply_nonmax_suppression: bool,
+                      mask: ArrayLike) -> ArrayLike:
+    if mask is not None and not mask.any():
+        return np.zeros(mask.shape, dtype='uint64')
+
+    input_ = cp.asarray(boundary_pmaps)
+
+    # distance to the nearest boundary voxel
+    dt = cu_distance_transform_edt(input_ <= threshold, sampling=pixel_pitch).astype(cp.float32)
+    if mask is not None:
+        dt[~cp.asarray(mask)] = 0.
+
+    if sigma_seeds:
+        dt = cu_ndimage.gaussian_filter(dt, sigma_seeds)
+
+    # seeds are extracted on cpu with the same local maxima as dt_watershed
+    dt_host = cp.asnumpy(dt)
+    seeds = _local_maxima(dt_host)
+
+    # normalize and invert distance transform and blend it with the input
+    dt = 1. - (dt - dt.min()) / dt.max()
+    if sigma_weights:
+        input_ = cu_ndimage.gaussian_filter(input_, sigma_weights)
+    hmap = alpha * input_ + (1. - alpha) * dt
+
+    # seeds labeling and seeded watershed run on cpu
+    return _finalize_dt_watershed(dt_host, seeds, cp.asnumpy(hmap).astype('float32'),
+                                  min_size=min_size,
+                                  apply_nonmax_suppression=apply_nonmax_suppression,
+                                  mask=mask)
+
+
+def dt_watershed_gpu(boundary_pmaps: ArrayLike,
+                     threshold: float = 0.5,
+                     sigma_seeds: float = 1.,
+                     stacked: bool = False,
+                     sigma_weights: float = 2.,
+                     min_size: int = 100,
+                     alpha: float = 1.0,
+                     pixel_pitch: List[int] = None,
+                     apply_nonmax_suppression: bool = False,
+                     mask: ArrayLike = None) -> ArrayLike:
+    """ GPU version of dt_watershed, distance transform, smoothing and height map run on device (cuCIM)
+
+    Args:
+        see dt_watershed, seeds extraction and the seeded watershed run on cpu as in dt_watershed
+
+    Returns:
+        np.ndarray: watershed segmentation
+    """
+    if not cucim_installed:
+        raise ValueError('please install cupy and cucim before running the watershed on gpu')
+
+    boundary_pmaps = _as_f32(boundary_pmaps)
+    ws_kwargs = dict(threshold=threshold, sigma_seeds=sigma_seeds,
+                     sigma_weights=sigma_weights,
+                     min_size=min_size, alpha=alpha,
+                     apply_nonmax_suppression=apply_nonmax_suppression)
+    if not stacked:
+        # WS in 3D
+        return _dt_watershed_gpu(boundary_pmaps, pixel_pitch=pixel_pitch, mask=mask, **ws_kwargs)
+
+    # WS in 2D, labels are offset across slices
+    pixel_pitch = pixel_pitch[1:] if pixel_pitch is not None else None
+    ws = np.zeros(boundary_pmaps.shape, dtype='uint64')
+    for z in range(boundary_pmaps.shape[0]):
+        _mask = mask[z] if mask is not None else None
+        ws[z] = _dt_watershed_gpu(boundary_pmaps[z], pixel_pitch=pixel_pitch, mask=_mask, **ws_kwargs)
+    offset_stacked_labels(ws)
+    return ws
+
+
 def gasp(boundary_pmaps: ArrayLike,
          superpixels: ArrayLike = None,
          gasp_linkage_criteria: str = 'average',
@@ -99,15 +401,11 @@ def gasp(boundary_pmaps: ArrayLike,
                        'use_efficient_implementations': False}
 
     # pmaps are interpreted as affinities
-    boundary_pmaps = boundary_pmaps.astype('float32')
-    affinities = np.stack([boundary_pmaps, boundary_pmaps, boundary_pmaps], axis=0)
+    boundary_pmaps = _as_f32(boundary_pmaps)
 
     offsets = [[0, 0, 1], [0, 1, 0], [1, 0, 0]]
-    # Shift is required to correct aligned affinities
-    affinities = shift_affinities(affinities, offsets=offsets)
-
-    # invert affinities
-    affinities = 1 - affinities
+    # Shift is required to correct aligned affinities, stack + shift + inversion are fused in a single pass
+    affinities = build_inverted_affinities(boundary_pmaps, offsets=offsets)
 
     # Init and run Gasp
     gasp_instance = GaspFromAffinities(offsets,
@@ -120,7 +418,7 @@ def gasp(boundary_pmaps: ArrayLike,
 
     # init and run size threshold
     if post_minsize > 0:
-        segmentation, _ = apply_size_filter(segmentation.astype('uint32'), boundary_pmaps, post_minsize)
+        segmentation = merge_small_segments(segmentation, boundary_pmaps, post_minsize)
     return segmentation
 
 
@@ -140,11 +438,12 @@ def mutex_ws(boundary_pmaps: ArrayLike,
 def multicut(boundary_pmaps: ArrayLike,
              superpixels: ArrayLike,
              beta: float = 0.5,
-             post_minsize: int = 50) -> ArrayLike:
-    rag = compute_rag(superpixels)
+             post_minsize: int = 50,
+             rag=None) -> ArrayLike:
+    rag = compute_rag(superpixels) if rag is None else rag
 
     # Prob -> edge costs
-    boundary_pmaps = boundary_pmaps.astype('float32')
+    boundary_pmaps = _as_f32(boundary_pmaps)
     costs = compute_mc_costs(boundary_pmaps, rag, beta=beta)
 
     # Creating graph
@@ -153,13 +452,11 @@ def multicut(boundary_pmaps: ArrayLike,
 
     # Solving Multicut
     node_labels = multicut_kernighan_lin(graph, costs)
-    segmentation = nifty.tools.take(node_labels, superpixels)
+    segmentation = parallel_take(node_labels, superpixels)
 
     # run size threshold
     if post_minsize > 0:
-        segmentation, _ = apply_size_filter(segmentation.astype('uint32'),
-                                            boundary_pmaps,
-                                            post_minsize)
+        segmentation = merge_small_segments(segmentation, boundary_pmaps, post_minsize)
     return segmentation
 
 
@@ -167,16 +464,17 @@ def lifted_multicut_from_nuclei_pmaps(boundary_pmaps: ArrayLike,
                                       nuclei_pmaps: ArrayLike,
                                       superpixels: ArrayLike,
                                       beta: float = 0.5,
-                                      post_minsize: int = 50) -> ArrayLike:
+                                      post_minsize: int = 50,
+                                      rag=None) -> ArrayLike:
     # compute the region adjacency graph
-    rag = compute_rag(superpixels)
+    rag = compute_rag(superpixels) if rag is None else rag
 
     # compute multi cut edges costs
-    boundary_pmaps = boundary_pmaps.astype('float32')
+    boundary_pmaps = _as_f32(boundary_pmaps)
     costs = compute_mc_costs(boundary_pmaps, rag, beta)
 
     # assert nuclei pmaps are floats
-    nuclei_pmaps = nuclei_pmaps.astype('float32')
+    nuclei_pmaps = _as_f32(nuclei_pmaps)
     input_maps = [nuclei_pmaps]
     assignment_threshold = .9
 
@@ -192,7 +490,7 @@ def lifted_multicut_from_nuclei_pmaps(boundary_pmaps: ArrayLike,
 
     # run size threshold
     if post_minsize > 0:
-        segmentation, _ = apply_size_filter(segmentation.astype('uint32'), boundary_pmaps, post_minsize)
+        segmentation = merge_small_segments(segmentation, boundary_pmaps, post_minsize)
     return segmentation
 
 
@@ -200,12 +498,13 @@ def lifted_multicut_from_nuclei_segmentation(boundary_pmaps: ArrayLike,
                                              nuclei_seg: ArrayLike,
                                              superpixels: ArrayLike,
                                              beta: float = 0.5,
-                                             post_minsize: int = 50) -> ArrayLike:
+                                             post_minsize: int = 50,
+                                             rag=None) -> ArrayLike:
     # compute the region adjacency graph
-    rag = compute_rag(superpixels)
+    rag = compute_rag(superpixels) if rag is None else rag
 
     # compute multi cut edges costs
-    boundary_pmaps = boundary_pmaps.astype('float32')
+    boundary_pmaps = _as_f32(boundary_pmaps)
     costs = compute_mc_costs(boundary_pmaps, rag, beta)
     max_cost = np.abs(np.max(costs))
     lifted_uvs, lifted_costs = lifted_problem_from_segmentation(rag, superpixels, nuclei_seg,
@@ -223,7 +522,7 @@ def lifted_multicut_from_nuclei_segmentation(boundary_pmaps: ArrayLike,
 
     # run size threshold
     if post_minsize > 0:
-        segmentation, _ = apply_size_filter(segmentation.astype('uint32'), boundary_pmaps, post_minsize)
+        segmentation = merge_small_segments(segmentation, boundary_pmaps, post_minsize)
     return segmentation
 
 
@@ -1,7 +1,11 @@
+import numba
 import numpy as np
 from elf.segmentation import compute_boundary_mean_and_length
+from elf.segmentation.features import compute_rag
 from elf.segmentation.multicut import transform_probabilities_to_costs
 
+from plantseg.segmentation.functional._cc_numba import merge_small
+
 
 def shift_affinities(affinities, offsets):
     rolled_affs = []
@@ -29,6 +33,61 @@ def shift_affinities(affinities, offsets):
     return rolled_affs
 
 
+@numba.njit(parallel=True, cache=True)
+def _build_inverted_affinities(boundary_pmaps, shifts, out):
+    shape_z, shape_y, shape_x = boundary_pmaps.shape
+    for c in range(shifts.shape[0]):
+        shift_z, shift_y, shift_x = shifts[c, 0], shifts[c, 1], shifts[c, 2]
+        for z in numba.prange(shape_z):
+            zz = z - shift_z
+            for y in range(shape_y):
+                yy = y - shift_y
+                for x in range(shape_x):
+                    xx = x - shift_x
+                    if 0 <= zz < shape_z and 0 <= yy < shape_y and 0 <= xx < shape_x:
+                        out[c, z, y, x] = 1. - boundary_pmaps[zz, yy, xx]
+                    else:
+                        # out of bounds values are zero padded before inversion
+                        out[c, z, y, x] = 1.
+
+
+def build_inverted_affinities(boundary_pmaps, offsets):
+    """
+    Single pass equivalent of: 1 - shift_affinities(np.stack([boundary_pmaps] * len(offsets)), offsets)
+    """
+    shifts = np.array([[int(off / 2) for off in offset] for offset in offsets], dtype=np.int64)
+    out = np.empty((len(offsets),) + boundary_pmaps.shape, dtype=np.float32)
+    _build_inverted_affinities(boundary_pmaps, shifts, out)
+    return out
+
+
+@numba.njit(parallel=True, cache=True)
+def _parallel_take(labels, flat_superpixels, out):
+    for i in numba.prange(flat_superpixels.shape[0]):
+        out[i] = labels[flat_superpixels[i]]
+
+
+def parallel_take(labels, superpixels):
+    """
+    Parallel equivalent of nifty.tools.take(labels, superpixels), a lookup table gather over the superpixels
+    """
+    flat_superpixels = np.ascontiguousarray(superpixels).reshape(-1)
+    out = np.empty(flat_superpixels.shape, dtype=labels.dtype)
+    _parallel_take(labels, flat_superpixels, out)
+    return out.reshape(superpixels.shape)
+
+
+def offset_stacked_labels(labels, offset=0):
+    """
+    Offset in place the labels of each slice of labels (along the first axis) so that they do not clash,
+    background stays 0. Returns the largest label, to be used as offset for the next stack
+    """
+    for labels_z in labels:
+        labels_z[labels_z != 0] += offset
+        offset = max(offset, int(labels_z.max()))
+    return offset
+
+
 def compute_mc_costs(boundary_pmaps, rag, beta):
     # compute the edge costs
     features = compute_boundary_mean_and_length(rag, boundary_pmaps)
@@ -41,3 +100,18 @@ def compute_mc_costs(boundary_pmaps, rag, beta):
 
     costs = transform_probabilities_to_costs(costs, edge_sizes=sizes, beta=beta)
     return costs
+
+
+def merge_small_segments(segmentation, boundary_pmaps, min_size):
+    """
+    Merge segments smaller than min_size into their neighbours, lowest (mean boundary) edges are merged first
+    """
+    segmentation = segmentation.astype('uint32')
+    rag = compute_rag(segmentation)
+    features = compute_boundary_mean_and_length(rag, boundary_pmaps)
+    uv_ids = rag.uvIds()
+    # contiguous float32 weights, the merge order is a single argsort over them
+    edge_weights = np.ascontiguousarray(features[:, 0], dtype=np.float32)
+    sizes = np.bincount(segmentation.ravel(), minlength=rag.numberOfNodes)
+    segmentation = merge_small(segmentation.ravel(), uv_ids[:, 0], uv_ids[:, 1], edge_weights, sizes, min_size)
+    return segmentation.reshape(boundary_pmaps.shape)
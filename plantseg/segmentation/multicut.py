@@ -1,8 +1,6 @@
 import time
 from functools import partial
 
-from elf.segmentation.watershed import apply_size_filter
-
 from plantseg.pipeline import gui_logger
 from plantseg.pipeline.steps import AbstractSegmentationStep
 from plantseg.segmentation.functional.segmentation import dt_watershed, multicut
@@ -61,9 +59,6 @@ class MulticutFromPmaps(AbstractSegmentationStep):
                                 beta=self.beta,
                                 post_minsize=self.post_minsize)
 
-        if self.post_minsize > self.ws_minsize:
-            segmentation, _ = apply_size_filter(segmentation, pmaps, self.post_minsize)
-
         # stop real world clock timer
         runtime = time.time() - runtime
         gui_logger.info(f"Clustering took {runtime:.2f} s")
@@ -1,3 +1,5 @@
+import weakref
+from collections import OrderedDict
 from concurrent.futures import Future
 from functools import partial
 from typing import Union, Tuple, Callable
@@ -5,19 +7,17 @@ from typing import Union, Tuple, Callable
 from magicgui import magicgui
 from napari.layers import Labels, Image, Layer
 from napari.types import LayerDataTuple
-from enum import Enum
 
 from plantseg.dataprocessing.functional.advanced_dataprocessing import fix_over_under_segmentation_from_nuclei
-from plantseg.dataprocessing.functional.dataprocessing import normalize_01
-from plantseg.viewer.widget.utils import start_threading_process, build_nice_name, layer_properties
-from plantseg.segmentation.functional import gasp, multicut, dt_watershed, mutex_ws
+from plantseg.dataprocessing._kernels import normalize_invert_mask
+from plantseg.viewer.widget.utils import start_threading_process, build_nice_name, layer_properties, downcast_labels
+from plantseg.viewer.widget.utils import is_temporary_input
+from plantseg.segmentation.functional import gasp, multicut, dt_watershed_gpu, mutex_ws
 from plantseg.segmentation.functional import lifted_multicut_from_nuclei_segmentation, lifted_multicut_from_nuclei_pmaps
+from plantseg.segmentation.functional import compute_dt_seeds, finalize_dt_watershed, tiled_dt_watershed
 
 
-class ClusteringOptions(Enum):
-    gasp = gasp
-    multicut = multicut
-    mutex_ws = mutex_ws
+_AGG_FUNCS = {'GASP': gasp, 'MutexWS': mutex_ws, 'MultiCut': multicut}
 
 
 def _generic_clustering(image: Image, labels: Labels,
@@ -51,7 +51,7 @@ def _generic_clustering(image: Image, labels: Labels,
           _labels={'label': 'Over-segmentation',
                    'tooltip': 'Over-segmentation labels layer to use as input for clustering.'},
           mode={'label': 'Aggl. Mode',
-                'choices': ['GASP', 'MutexWS', 'MultiCut'],
+                'choices': list(_AGG_FUNCS.keys()),
                 'tooltip': 'Select which agglomeration algorithm to use.'
                 },
           beta={'label': 'Under/Over segmentation factor',
@@ -64,15 +64,7 @@ def widget_agglomeration(image: Image, _labels: Labels,
                          mode: str = "GASP",
                          beta: float = 0.6,
                          minsize: int = 100) -> Future[LayerDataTuple]:
-    if mode == 'GASP':
-        func = gasp
-
-    elif mode == 'MutexWS':
-        func = mutex_ws
-
-    else:
-        func = multicut
-
+    func = _AGG_FUNCS[mode]
     return _generic_clustering(image, _labels, beta=beta, minsize=minsize, name=mode, agg_func=func)
 
 
@@ -124,6 +116,47 @@ def widget_lifted_multicut(image: Image,
                                    )
 
 
+_DT_CACHE = OrderedDict()
+_DT_CACHE_SIZE = 2
+
+
+def _compute_dt(input_pmaps, boundary_pmaps, mask, threshold, sigma_seeds, sigma_weights, alpha, pixel_pitch, nuclei,
+                stacked):
+    """
+    Distance transform, seeds and height map of boundary_pmaps (input_pmaps after the nuclei preprocessing)
+    with a bounded LRU cache, entries are keyed on a weak reference to input_pmaps, so that only the parameters
+    that do not affect the distance transform can change. Entries are evicted as soon as input_pmaps is released
+    """
+    pixel_pitch = tuple(pixel_pitch) if pixel_pitch is not None else None
+    key = (id(input_pmaps), input_pmaps.shape, input_pmaps.strides, input_pmaps.dtype.str,
+           threshold, sigma_seeds, sigma_weights, alpha, pixel_pitch, nuclei, stacked)
+    cached = _DT_CACHE.get(key)
+    if cached is not None and cached[0]() is input_pmaps:
+        _DT_CACHE.move_to_end(key)
+        return cached[1]
+
+    result = compute_dt_seeds(boundary_pmaps,
+                              threshold=threshold,
+                              sigma_seeds=sigma_seeds,
+                              stacked=stacked,
+                              sigma_weights=sigma_weights,
+                              alpha=alpha,
+                              pixel_pitch=pixel_pitch,
+                              mask=mask)
+
+    # a copy made for this run can never be looked up again
+    if not is_temporary_input(input_pmaps):
+        pmaps_ref = weakref.ref(input_pmaps, lambda _ref: _DT_CACHE.pop(key, None))
+        _DT_CACHE[key] = (pmaps_ref, result)
+        if len(_DT_CACHE) > _DT_CACHE_SIZE:
+            _DT_CACHE.popitem(last=False)
+    return result
+
+
+# 3D volumes larger than this are segmented in overlapping z-blocks
+_TILED_DTWS_MIN_BYTES = 512 * 1024 ** 2
+
+
 def dtws_wrapper(boundary_pmaps,
                  stacked: bool = True,
                  threshold: float = 0.5,
@@ -133,25 +166,55 @@ def dtws_wrapper(boundary_pmaps,
                  alpha: float = 1.,
                  pixel_pitch: Tuple[int, int, int] = (1, 1, 1),
                  apply_nonmax_suppression: bool = False,
-                 nuclei: bool = False):
+                 nuclei: bool = False,
+                 device: str = 'cpu'):
+    input_pmaps = boundary_pmaps
     if nuclei:
-        boundary_pmaps = normalize_01(boundary_pmaps)
-        boundary_pmaps = 1. - boundary_pmaps
-        mask = boundary_pmaps < threshold
+        boundary_pmaps, mask = normalize_invert_mask(boundary_pmaps, threshold)
     else:
         mask = None
 
-    return dt_watershed(boundary_pmaps=boundary_pmaps,
-                        threshold=threshold,
-                        min_size=min_size,
-                        stacked=stacked,
-                        sigma_seeds=sigma_seeds,
-                        sigma_weights=sigma_weights,
-                        alpha=alpha,
-                        pixel_pitch=pixel_pitch,
-                        apply_nonmax_suppression=apply_nonmax_suppression,
-                        mask=mask
-                        )
+    if device == 'cuda':
+        segmentation = dt_watershed_gpu(boundary_pmaps=boundary_pmaps,
+                                        threshold=threshold,
+                                        min_size=min_size,
+                                        stacked=stacked,
+                                        sigma_seeds=sigma_seeds,
+                                        sigma_weights=sigma_weights,
+                                        alpha=alpha,
+                                        pixel_pitch=pixel_pitch,
+                                        apply_nonmax_suppression=apply_nonmax_suppression,
+                                        mask=mask
+                                        )
+        return downcast_labels(segmentation)
+
+    if not stacked and boundary_pmaps.nbytes > _TILED_DTWS_MIN_BYTES:
+        segmentation = tiled_dt_watershed(boundary_pmaps,
+                                          threshold=threshold,
+                                          min_size=min_size,
+                                          sigma_seeds=sigma_seeds,
+                                          sigma_weights=sigma_weights,
+                                          alpha=alpha,
+                                          pixel_pitch=pixel_pitch,
+                                          apply_nonmax_suppression=apply_nonmax_suppression,
+                                          mask=mask)
+        return downcast_labels(segmentation)
+
+    # only the cheap seeded watershed is recomputed when min_size or apply_nonmax_suppression change
+    dt, seeds, hmap = _compute_dt(input_pmaps, boundary_pmaps, mask,
+                                  threshold=threshold,
+                                  sigma_seeds=sigma_seeds,
+                                  sigma_weights=sigma_weights,
+                                  alpha=alpha,
+                                  pixel_pitch=pixel_pitch,
+                                  nuclei=nuclei,
+                                  stacked=stacked)
+    segmentation = finalize_dt_watershed(dt, seeds, hmap,
+                                         stacked=stacked,
+                                         min_size=min_size,
+                                         apply_nonmax_suppression=apply_nonmax_suppression,
+                                         mask=mask)
+    return downcast_labels(segmentation)
 
 
 @magicgui(call_button='Run Watershed',
@@ -175,8 +238,12 @@ def dtws_wrapper(boundary_pmaps,
           use_pixel_pitch={'label': 'Use pixel pitch'},
           pixel_pitch={'label': 'Pixel pitch'},
           apply_nonmax_suppression={'label': 'Apply nonmax suppression'},
-          nuclei={'label': 'Is image Nuclei'}
-
+          nuclei={'label': 'Is image Nuclei'},
+          use_gpu={'label': 'Use GPU',
+                   'tooltip': 'Compute distance transform and seeds on GPU (requires cupy and cucim).'},
+          progressive={'label': 'Show progress',
+                       'tooltip': 'Display the slices as soon as they are segmented '
+                                  '(2D stacked mode only, not available for nuclei).'}
           )
 def widget_dt_ws(image: Image,
                  stacked: str = '2D',
@@ -188,7 +255,9 @@ def widget_dt_ws(image: Image,
                  use_pixel_pitch: bool = False,
                  pixel_pitch: Tuple[int, int, int] = (1, 1, 1),
                  apply_nonmax_suppression: bool = False,
-                 nuclei: bool = False) -> Future[LayerDataTuple]:
+                 nuclei: bool = False,
+                 use_gpu: bool = False,
+                 progressive: bool = False) -> Future[LayerDataTuple]:
     out_name = build_nice_name(image.name, 'dtWS')
     inputs_names = (image.name,)
     layer_kwargs = layer_properties(name=out_name,
@@ -206,7 +275,8 @@ def widget_dt_ws(image: Image,
                        alpha=alpha,
                        pixel_pitch=pixel_pitch,
                        apply_nonmax_suppression=apply_nonmax_suppression,
-                       nuclei=nuclei)
+                       nuclei=nuclei,
+                       device='cuda' if use_gpu else 'cpu')
 
     return start_threading_process(dtws_wrapper,
                                    runtime_kwargs={'boundary_pmaps': image.data},
@@ -216,6 +286,8 @@ def widget_dt_ws(image: Image,
                                    layer_kwarg=layer_kwargs,
                                    layer_type=layer_type,
                                    step_name=f'Watershed Segmentation',
+                                   # nuclei are normalized over the whole volume, slabs can not be processed independently
+                                   progressive=progressive and stacked and not nuclei,
                                    )
 
 
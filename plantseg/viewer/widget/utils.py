@@ -1,17 +1,251 @@
-from concurrent.futures import Future
+import os
+import re
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
 from typing import Callable, Tuple
 
+import napari
+import numpy as np
 from napari.qt.threading import thread_worker
-from napari.utils.notifications import show_info
+from napari.utils.notifications import show_info, show_error
+from PyQt5.QtCore import QObject, pyqtSignal
 
+from plantseg.segmentation.functional.utils import offset_stacked_labels
 from plantseg.viewer.dag_handler import dag_manager
 
+# persistent pool shared by all widgets, avoids spawning a new thread for every run
+_PLANTSEG_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='plantseg')
+
+
+class _MainThreadInvoker(QObject):
+    """
+    Run callables on the Qt main thread, signals emitted from the pool threads are queued to the main event loop
+    """
+    invoke = pyqtSignal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.invoke.connect(lambda callback: callback())
+
+
+# created at import, thus it lives in the main thread
+_main_thread = _MainThreadInvoker()
+
+
+# results of the most recent runs, identical repeated runs are served from here. Inputs are identified by the identity
+# of the layer data, the cache is cleared whenever the data of a layer is replaced or painted
+_RUN_CACHE = OrderedDict()
+_RUN_CACHE_SIZE = 8
+_WATCHED_VIEWERS = weakref.WeakSet()
+# bumped on every clear, runs started before an edit are not cached
+_RUN_CACHE_GENERATION = [0]
+
+
+def _clear_run_cache(event=None):
+    _RUN_CACHE.clear()
+    _RUN_CACHE_GENERATION[0] += 1
+
+
+def _watch_layer(layer):
+    layer.events.data.connect(_clear_run_cache)
+    if hasattr(layer.events, 'paint'):
+        layer.events.paint.connect(_clear_run_cache)
+
+
+def _watch_viewer():
+    """ clear the run cache on every edit of the layers of the current viewer """
+    viewer = napari.current_viewer()
+    if viewer is None or viewer in _WATCHED_VIEWERS:
+        return
+
+    _WATCHED_VIEWERS.add(viewer)
+    for layer in viewer.layers:
+        _watch_layer(layer)
+    viewer.layers.events.inserted.connect(lambda event: _watch_layer(event.value))
+
+
+def _run_cache_key(func: Callable, runtime_kwargs: dict, input_keys, out_name):
+    """ Key of a run and weak references to its input arrays, or (None, None) if the run can not be cached """
+    key_items, input_refs = [], []
+    for name, value in sorted(runtime_kwargs.items()):
+        if isinstance(value, np.ndarray):
+            # the id is only meaningful while the array is alive, hence the weak reference
+            input_refs.append(weakref.ref(value))
+            value = (id(value), value.shape, value.dtype.str, value.strides)
+        elif hasattr(value, 'compute'):
+            return None, None
+        key_items.append((name, value))
+
+    key = (func.__qualname__, tuple(input_keys), out_name, tuple(key_items))
+    try:
+        hash(key)
+    except TypeError:
+        return None, None
+    return key, input_refs
+
+
+def _get_cached_run(key):
+    if key is None or key not in _RUN_CACHE:
+        return None
+
+    input_refs, result_ref = _RUN_CACHE[key]
+    result = result_ref()
+    # the ids in the key may belong to new arrays once an input was released
+    if result is None or any(input_ref() is None for input_ref in input_refs):
+        del _RUN_CACHE[key]
+        return None
+
+    _RUN_CACHE.move_to_end(key)
+    return result
+
+
+def _add_cached_run(key, input_refs, result, generation):
+    if key is None or not isinstance(result, np.ndarray) or generation != _RUN_CACHE_GENERATION[0]:
+        return
+
+    _RUN_CACHE[key] = (input_refs, weakref.ref(result))
+    if len(_RUN_CACHE) > _RUN_CACHE_SIZE:
+        _RUN_CACHE.popitem(last=False)
+
 
 def identity(x):
     return x
 
 
+# runtime inputs always consumed as float32 by the segmentation functions
+FLOAT32_INPUTS = {'boundary_pmaps', 'nuclei_pmaps'}
+
+
+# runtime label inputs, napari labels are int64 but nifty/vigra work on uint32 labels
+LABEL_INPUTS = {'superpixels', 'nuclei_seg'}
+
+
+def downcast_labels(labels: np.ndarray) -> np.ndarray:
+    """
+    Cast labels to uint32 (no copy if they already are), labels that do not fit are returned unchanged
+    """
+    if labels.dtype == np.uint32 or labels.size == 0:
+        return labels
+
+    min_label, max_label = labels.min(), labels.max()
+    if min_label < 0 or max_label >= 2 ** 32:
+        show_info(f'Napari - PlantSeg info: labels in [{min_label}, {max_label}] do not fit in uint32, '
+                  f'keeping {labels.dtype}')
+        return labels
+    return labels.astype(np.uint32, copy=False)
+
+
+# copies made by _normalize_runtime_kwargs, they only live as long as the run that made them
+_TEMPORARY_INPUTS = weakref.WeakValueDictionary()
+
+
+def is_temporary_input(array: np.ndarray) -> bool:
+    """ True if array is a copy made for a single run rather than the data of a layer """
+    return _TEMPORARY_INPUTS.get(id(array)) is array
+
+
+def _normalize_runtime_kwargs(runtime_kwargs: dict) -> dict:
+    """
+    Materialize lazy (dask) arrays and make arrays contiguous (float32 for probability maps, uint32 for labels) once,
+    so that downstream nifty/vigra code does not silently copy them again
+    """
+    normalized_kwargs = {}
+    for key, value in runtime_kwargs.items():
+        original_value = value
+        if hasattr(value, 'compute'):
+            value = value.compute()
+
+        if isinstance(value, np.ndarray):
+            if key in LABEL_INPUTS:
+                value = downcast_labels(value)
+            dtype = np.float32 if key in FLOAT32_INPUTS else value.dtype
+            value = np.ascontiguousarray(value, dtype=dtype)
+            if value is not original_value:
+                _TEMPORARY_INPUTS[id(value)] = value
+
+        normalized_kwargs[key] = value
+    return normalized_kwargs
+
+
+# number of z-slabs yielded by progressive runs
+PROGRESSIVE_NUM_SLABS = 8
+
+
+def _progressive_run(func: Callable, runtime_kwargs: dict, statics_kwargs: dict, layer_type: str):
+    """
+    Run func slab by slab along z and yield the partially filled output after every slab,
+    func must process z-slices independently (e.g. stacked 2D segmentation)
+    """
+    runtime_kwargs = _normalize_runtime_kwargs(runtime_kwargs)
+    shape_z = next(iter(runtime_kwargs.values())).shape[0]
+    slab_size = -(-shape_z // PROGRESSIVE_NUM_SLABS)
+
+    out, offset = None, 0
+    for z in range(0, shape_z, slab_size):
+        slab_kwargs = {key: value[z:z + slab_size] for key, value in runtime_kwargs.items()}
+        result = func(**slab_kwargs, **statics_kwargs)
+        if out is None:
+            out = np.zeros((shape_z,) + result.shape[1:], dtype=result.dtype)
+
+        if layer_type == 'labels':
+            # labels are offset across slabs, each slab as a whole
+            offset = offset_stacked_labels(result[None], offset)
+
+        out[z:z + slab_size] = result
+        yield out
+    return out
+
+
+def _start_progressive_process(func: Callable,
+                               runtime_kwargs: dict,
+                               statics_kwargs: dict,
+                               out_name: str,
+                               input_keys: Tuple[str, ...],
+                               layer_kwarg: dict,
+                               layer_type: str,
+                               step_name: str,
+                               skip_dag: bool) -> Future:
+    future = Future()
+    progressive_layer = {}
+
+    def on_yielded(partial_result):
+        # the output layer is created at the first slab and refreshed afterwards
+        if 'layer' not in progressive_layer:
+            add_layer = getattr(napari.current_viewer(), f'add_{layer_type}')
+            progressive_layer['layer'] = add_layer(partial_result, **layer_kwarg)
+        else:
+            progressive_layer['layer'].data = partial_result
+            progressive_layer['layer'].refresh()
+
+    def on_errored(exception):
+        show_error(f'Napari - PlantSeg error: widget {step_name} computation failed: {exception}')
+        future.set_exception(exception)
+
+    def on_returned(result):
+        show_info(f'Napari - PlantSeg info: widget {step_name} computation complete')
+        _func = func if not skip_dag else identity
+        dag_manager.add_step(_func, input_keys=input_keys,
+                             output_key=out_name,
+                             static_params=statics_kwargs,
+                             step_name=step_name)
+        # the layer already exists, nothing is left for magicgui to add
+        future.set_result(None)
+
+    worker = thread_worker(partial(_progressive_run,
+                                   func=func,
+                                   runtime_kwargs=runtime_kwargs,
+                                   statics_kwargs=statics_kwargs,
+                                   layer_type=layer_type))()
+    worker.yielded.connect(on_yielded)
+    worker.returned.connect(on_returned)
+    worker.errored.connect(on_errored)
+    worker.start()
+    show_info(f'Napari - PlantSeg info: widget {step_name} computation started')
+    return future
+
+
 def start_threading_process(func: Callable,
                             runtime_kwargs: dict,
                             statics_kwargs: dict,
@@ -20,25 +254,65 @@ def start_threading_process(func: Callable,
                             layer_kwarg: dict,
                             layer_type: str = 'image',
                             step_name: str = '',
-                            skip_dag: bool = False) -> Future:
+                            skip_dag: bool = False,
+                            force: bool = False,
+                            progressive: bool = False) -> Future:
 
-    runtime_kwargs.update(statics_kwargs)
-    thread_func = thread_worker(partial(func, **runtime_kwargs))
     future = Future()
+    if progressive:
+        return _start_progressive_process(func, runtime_kwargs, statics_kwargs,
+                                          out_name=out_name,
+                                          input_keys=input_keys,
+                                          layer_kwarg=layer_kwarg,
+                                          layer_type=layer_type,
+                                          step_name=step_name,
+                                          skip_dag=skip_dag)
 
-    def on_done(result):
-        show_info(f'Napari - PlantSeg info: widget {step_name} computation complete')
-        _func = func if not skip_dag else identity
-        dag_manager.add_step(_func, input_keys=input_keys,
-                             output_key=out_name,
-                             static_params=statics_kwargs,
-                             step_name=step_name)
-        result = result, layer_kwarg, layer_type
-        future.set_result(result)
+    runtime_kwargs.update(statics_kwargs)
+    # the cache is only accessed from the main thread
+    _watch_viewer()
+    generation = _RUN_CACHE_GENERATION[0]
+    key, input_refs = _run_cache_key(func, runtime_kwargs, input_keys, out_name)
+    cached_result = None if force else _get_cached_run(key)
 
-    worker = thread_func()
-    worker.returned.connect(on_done)
-    worker.start()
+    # the worker takes the inputs out of here, no reference to them is kept once the run started
+    pending_kwargs = [runtime_kwargs]
+    del runtime_kwargs
+
+    def _run():
+        runtime_kwargs = pending_kwargs.pop()
+        if cached_result is not None:
+            # the cached result is owned by an existing layer
+            return cached_result.copy(), True
+
+        # inputs are normalized inside the worker to keep the viewer responsive
+        normalized_kwargs = _normalize_runtime_kwargs(runtime_kwargs)
+        return func(**normalized_kwargs), False
+
+    def on_done(task: Future):
+        exception = task.exception()
+        if exception is not None:
+            show_error(f'Napari - PlantSeg error: widget {step_name} computation failed: {exception}')
+            future.set_exception(exception)
+            return
+
+        result, is_cached = task.result()
+        if is_cached:
+            # identical to a recent run, its dag step already exists
+            show_info(f'Napari - PlantSeg info: widget {step_name} result reused from a previous identical run')
+        else:
+            show_info(f'Napari - PlantSeg info: widget {step_name} computation complete')
+            _func = func if not skip_dag else identity
+            dag_manager.add_step(_func, input_keys=input_keys,
+                                 output_key=out_name,
+                                 static_params=statics_kwargs,
+                                 step_name=step_name)
+            _add_cached_run(key, input_refs, result, generation)
+        future.set_result((result, layer_kwarg, layer_type))
+
+    task = _PLANTSEG_POOL.submit(_run)
+    # the done callback runs in the pool thread, the result is handled on the Qt main thread
+    task.add_done_callback(lambda _task: _main_thread.invoke.emit(partial(on_done, _task)))
     show_info(f'Napari - PlantSeg info: widget {step_name} computation started')
     return future
 
@@ -52,26 +326,16 @@ def layer_properties(name, scale, metadata: dict = None):
     return {'name': name, 'scale': scale, 'metadata': _new_metadata}
 
 
-def _find_version(old_suffix, new_suffix):
-    s_idx = old_suffix.find(new_suffix)
-    if s_idx != -1:
-        v_idx = s_idx + len(new_suffix)
-        old_suffix, current_version = old_suffix[:v_idx], old_suffix[v_idx:]
-
-        current_version = 0 if current_version == '' else int(current_version[1:-1])
-        current_version += 1
-        new_version = f'[{current_version}]'
-        return old_suffix, new_version
-
-    return f'{old_suffix}_{new_suffix}', ''
+# layer name, optionally followed by a version tag, e.g. "raw_dtWS[2]"
+_NAME_RE = re.compile(r'^(?P<stem>.*?)(?:\[(?P<version>\d+)\])?$', re.DOTALL)
 
 
 def build_nice_name(base, new_suffix):
-    if base.find('_') == -1:
+    match = _NAME_RE.match(base)
+    stem, version = match['stem'], match['version']
+    if not stem.endswith(f'_{new_suffix}'):
         return f'{base}_{new_suffix}'
 
-    *base_without_suffix, old_suffix = base.split('_')
-    base_without_suffix = '_'.join(base_without_suffix)
-
-    new_suffix, version = _find_version(old_suffix, new_suffix)
-    return f'{base_without_suffix}_{new_suffix}{version}'
+    # same step applied again, bump the version
+    new_version = int(version or 0) + 1
+    return f'{stem}[{new_version}]'
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from plantseg.predictions.array_dataset import ReflectPadView
+
+
+@pytest.mark.parametrize('shape, pad_width', [
+    ((12, 20, 24), (4, 6, 6)),
+    ((2, 12, 20, 24), (4, 6, 6)),
+    ((1, 20, 24), (0, 8, 8)),
+])
+@pytest.mark.parametrize('patch', [
+    np.s_[:, :, :],
+    np.s_[5:9, 10:18, 8:20],
+    np.s_[0:6, 0:10, 0:12],
+    np.s_[-6:, -10:, -12:],
+    np.s_[2:14, 3:30, 1:34],
+])
+def test_reflect_pad_view(shape, pad_width, patch):
+    array = np.random.rand(*shape).astype('float32')
+    num_channel_axes = array.ndim - len(pad_width)
+    expected = np.pad(array, ((0, 0),) * num_channel_axes + tuple((p, p) for p in pad_width), mode='reflect')
+
+    view = ReflectPadView(array, pad_width)
+    assert view.shape == expected.shape
+
+    patch = (slice(None),) * num_channel_axes + patch
+    np.testing.assert_array_equal(view[patch], expected[patch])
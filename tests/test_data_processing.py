@@ -2,9 +2,12 @@ import os
 
 import h5py
 import numpy as np
+from scipy.ndimage import zoom, median_filter
+from skimage.morphology import ball
 
 from plantseg.dataprocessing.dataprocessing import DataPostProcessing3D, DataPreProcessing3D
-from plantseg.dataprocessing.functional.dataprocessing import image_gaussian_smoothing
+from plantseg.dataprocessing.functional.dataprocessing import image_gaussian_smoothing, image_rescale, image_median
+from plantseg.dataprocessing.functional.labelprocessing import set_background_to_value
 
 
 class TestDataProcessing:
@@ -130,3 +133,33 @@ class TestDataProcessing:
             voxel_size = f['raw'].attrs['element_size_um']
 
         assert np.allclose(expected_voxel_size, voxel_size)
+
+    def test_image_rescale(self):
+        image = np.random.rand(8, 32, 32).astype('float32')
+        for factor in ([1, 2, 2], [2, 1, 0.5], [2, 2, 2]):
+            assert np.allclose(image_rescale(image, factor, order=2), zoom(image, factor, order=2))
+
+    def test_image_median(self):
+        image = np.random.rand(8, 32, 32).astype('float32')
+        expected = median_filter(image, footprint=ball(2), mode='nearest')
+        assert np.array_equal(image_median(image, 2), expected)
+
+    def test_set_background_to_value(self):
+        def _expected(segmentation, value):
+            segmentation = segmentation + 1
+            idx, counts = np.unique(segmentation, return_counts=True)
+            bg_idx = idx[np.argmax(counts)]
+            return np.where(segmentation == bg_idx, value, segmentation)
+
+        segmentation = np.random.randint(1, 4, size=(4, 16, 16)).astype('uint32')
+        segmentation[:, :8] = 0
+        for value in (0, 7):
+            assert np.array_equal(set_background_to_value(segmentation, value), _expected(segmentation, value))
+
+        # sparse ids take the np.unique path
+        segmentation[:, 12:] = 2 ** 31
+        assert np.array_equal(set_background_to_value(segmentation, 0), _expected(segmentation, 0))
+
+        # float labels take the np.unique path as well
+        segmentation = segmentation.astype('float32')
+        assert np.array_equal(set_background_to_value(segmentation, 0), _expected(segmentation, 0))
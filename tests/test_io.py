@@ -0,0 +1,31 @@
+import h5py
+import numpy as np
+import pytest
+
+from plantseg.io.io import load_h5
+
+
+@pytest.mark.parametrize('slices', [
+    None,
+    np.s_[:],
+    np.s_[4:12],
+    np.s_[2:20:3, :64, 10:-10],
+    np.s_[5],
+    np.s_[5, 10:20],
+    np.s_[np.int64(3), :, 7],
+    np.s_[8:8],
+    np.s_[[1, 4, 9]],
+    np.s_[:, [0, 5, 17], :],
+    np.s_[..., 3],
+])
+def test_load_h5_slices(input_path, slices):
+    data, infos = load_h5(input_path, 'raw', slices=slices)
+
+    with h5py.File(input_path, 'r') as f:
+        expected = f['raw'][()] if slices is None else f['raw'][slices]
+        file_shape = f['raw'].shape
+
+    assert infos[1] == file_shape
+    assert data.dtype == expected.dtype
+    assert data.shape == expected.shape
+    np.testing.assert_array_equal(data, expected)
@@ -0,0 +1,127 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from plantseg.segmentation.functional import segmentation as seg_functional
+from plantseg.segmentation.functional import dt_watershed, compute_dt_seeds, finalize_dt_watershed
+from plantseg.segmentation.functional._cc_numba import merge_small
+from plantseg.segmentation.functional.utils import merge_small_segments, offset_stacked_labels, shift_affinities
+from plantseg.segmentation.functional.utils import build_inverted_affinities, parallel_take
+
+
+def _same_partition(labels_a, labels_b):
+    """ True if the two label images are equal up to a relabeling, background stays 0 """
+    if not np.array_equal(labels_a == 0, labels_b == 0):
+        return False
+    pairs = np.unique(np.stack([labels_a.ravel(), labels_b.ravel()]), axis=1)
+    return len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+
+
+class TestSegmentation:
+    def test_merge_small(self):
+        # 1 and 3 are large, 2 and 4 are small, 5 and 6 are small but together reach min_size
+        labels_flat = np.array([1, 1, 1, 1, 2, 3, 3, 3, 3, 4, 5, 6], dtype='uint32')
+        sizes = np.bincount(labels_flat)
+        edges_u = np.array([1, 2, 3, 5])
+        edges_v = np.array([2, 3, 4, 6])
+        edge_weights = np.array([0.9, 0.1, 0.5, 0.2], dtype='float32')
+
+        merged = merge_small(labels_flat, edges_u, edges_v, edge_weights, sizes, min_size=2)
+
+        # 2 and 4 are merged into 3 (lowest weight first), 1 is untouched since both sides of its edge are large
+        expected = np.array([1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 3, 3], dtype='uint32')
+        assert np.array_equal(merged, expected)
+
+    def test_merge_small_segments(self):
+        segmentation = np.ones((4, 10, 10), dtype='uint32')
+        segmentation[..., 5:] = 2
+        # small segment in the first half, touching the second one
+        segmentation[:2, :2, 3:5] = 3
+
+        # high boundary evidence inside the second half only, the small segment is merged into 1
+        boundary_pmaps = np.zeros(segmentation.shape, dtype='float32')
+        boundary_pmaps[..., 5:] = 1.
+
+        merged = merge_small_segments(segmentation, boundary_pmaps, min_size=10)
+
+        expected = np.where(segmentation == 3, 1, segmentation)
+        assert np.array_equal(merged, expected)
+
+    def test_offset_stacked_labels(self):
+        labels = np.array([[[0, 1], [2, 2]],
+                           [[1, 0], [1, 3]]], dtype='uint64')
+
+        assert offset_stacked_labels(labels, offset=1) == 6
+        assert np.array_equal(labels, [[[0, 2], [3, 3]],
+                                       [[4, 0], [4, 6]]])
+
+    def test_match_blocks(self):
+        seg_a_plane = np.zeros((8, 8), dtype='uint64')
+        seg_a_plane[:, :4] = 1
+        seg_a_plane[:, 4:] = 2
+
+        # 10 mostly overlaps 1
+        seg_b_plane = np.zeros((8, 8), dtype='uint64')
+        seg_b_plane[:, :5] = 10
+        # 11 overlaps 2 on a quarter of its area only, the rest is background in a
+        seg_b_plane[:, 6:] = 11
+        seg_a_plane[2:, 6:] = 0
+
+        pairs = seg_functional._match_blocks(seg_a_plane, seg_b_plane)
+        assert np.array_equal(pairs, np.array([[10], [1]]))
+
+    def test_tiled_dt_watershed(self, monkeypatch):
+        # labels are encoded in the input, the stubbed 3D watershed returns them for every block
+        def _dt_watershed(boundary_pmaps, stacked, sigma_weights, mask, **kwargs):
+            assert not stacked
+            return boundary_pmaps.astype('uint32')
+
+        monkeypatch.setattr(seg_functional, 'dt_watershed', _dt_watershed)
+
+        labels = np.zeros((20, 16, 16), dtype='uint32')
+        labels[:, :8, :8] = 1
+        labels[:12, 8:, :] = 2
+        labels[12:, 8:, :] = 3
+        labels[5:9, :8, 8:] = 4
+
+        segmentation = seg_functional.tiled_dt_watershed(labels.astype('float32'), z_block=4, halo=2)
+
+        assert _same_partition(segmentation, labels)
+
+    def test_two_stage_dt_watershed(self):
+        boundary_pmaps = gaussian_filter(np.random.rand(8, 64, 64), sigma=2).astype('float32')
+        boundary_pmaps = (boundary_pmaps - boundary_pmaps.min()) / (boundary_pmaps.max() - boundary_pmaps.min())
+        mask = np.zeros(boundary_pmaps.shape, dtype=bool)
+        mask[:, 8:56, 8:56] = True
+
+        for stacked in (False, True):
+            for _mask in (None, mask):
+                ws_kwargs = dict(threshold=0.5, sigma_seeds=1., sigma_weights=2., alpha=0.8,
+                                 pixel_pitch=None if stacked else (2, 1, 1))
+                expected = dt_watershed(boundary_pmaps, stacked=stacked, min_size=10, mask=_mask, **ws_kwargs)
+
+                dt, seeds, hmap = compute_dt_seeds(boundary_pmaps, stacked=stacked, mask=_mask, **ws_kwargs)
+                segmentation = finalize_dt_watershed(dt, seeds, hmap, stacked=stacked, min_size=10, mask=_mask)
+                assert _same_partition(segmentation, expected)
+
+    def test_build_inverted_affinities(self):
+        boundary_pmaps = np.random.rand(6, 20, 24).astype('float32')
+        for offsets in ([[0, 0, 1], [0, 1, 0], [1, 0, 0]], [[0, 0, -4], [0, 6, 0], [-3, 0, 5]]):
+            affinities = np.stack([boundary_pmaps] * len(offsets), axis=0)
+            expected = 1 - shift_affinities(affinities, offsets=offsets)
+
+            inverted_affinities = build_inverted_affinities(boundary_pmaps, offsets)
+            assert inverted_affinities.dtype == np.float32
+            np.testing.assert_array_equal(inverted_affinities, expected)
+
+    def test_parallel_take(self):
+        superpixels = np.random.randint(0, 50, size=(6, 20, 24)).astype('uint64')
+        labels = np.random.randint(0, 10, size=50).astype('uint64')
+        expected = np.take(labels, superpixels)
+
+        projected = parallel_take(labels, superpixels)
+        assert projected.dtype == expected.dtype
+        np.testing.assert_array_equal(projected, expected)
+
+        # non contiguous superpixels
+        np.testing.assert_array_equal(parallel_take(labels, superpixels[:, ::2, 1:]),
+                                      np.take(labels, superpixels[:, ::2, 1:]))